@@ -1,13 +1,16 @@
-import yaml
-import json
-from contextlib import closing
+from array import array
+from uuid import uuid4
+from itertools import chain, islice
+from queue import Queue
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
 from airflow.hooks.base import BaseHook
 from airflow.models import BaseOperator
 from airflow.utils.context import Context
 
 from typing import Union, Callable, Optional, Sequence
 
-from .utils import MappingElements, get_table, get_fields, normalize, flatten
+from .utils import compile_mapping, compile_query, make_converter, normalize, fetch, values_clause
 from .queries import (
     DROP_TABLE_QUERY,
     CREATE_TABLE_QUERY,
@@ -18,6 +21,10 @@ from .queries import (
 )
 
 
+# Number of rows fetched from source cursor at once
+FETCH_SIZE = 256
+
+
 DATABASES_MULTIPLE_VALUES_INSERT_SUPPORTS = (
     'clickhouse',
     'greenplum',
@@ -30,6 +37,28 @@ DATABASES_MULTIPLE_VALUES_INSERT_SUPPORTS = (
 )
 
 
+DATABASES_BULK_INSERT_SUPPORTS = (
+    'mysql',
+    'postgres',
+)
+
+
+DATABASES_SERVER_SIDE_CURSOR_SUPPORTS = (
+    'postgres',
+)
+
+
+DATABASES_PARALLEL_INSERT_SUPPORTS = (
+    'clickhouse',
+    'greenplum',
+    'mssql',
+    'mysql',
+    'postgres',
+    'presto',
+    'trino',
+)
+
+
 class NormalizerOperator(BaseOperator):
     """
     This operator allows you to read json data from one database and save it
@@ -56,6 +85,9 @@ class NormalizerOperator(BaseOperator):
         tables and continue id sequence, if False, each run starts full-refresh
         with id started with 1.
         (default value: False)
+    :param max_workers: maximum number of nested tables inserted concurrently,
+        each through its own connection.
+        (default value: 8)
     """
 
     template_fields: Sequence[str] = (
@@ -101,6 +133,7 @@ class NormalizerOperator(BaseOperator):
         select_max_query: Optional[str] = None,
         commit_every: Optional[int] = None,
         insert_args: Optional[dict] = None,
+        max_workers: Optional[int] = None,
         **kwargs,
     ) -> None:
         super().__init__(**kwargs)
@@ -122,6 +155,7 @@ class NormalizerOperator(BaseOperator):
         self.select_max_query = select_max_query or SELECT_MAX_QUERY
         self.commit_every = commit_every or 1000
         self.insert_args = insert_args or {}
+        self.max_workers = max_workers or 1
 
     def execute(self, context: Context):
         """Prepare and start normalization for every root table."""
@@ -129,62 +163,48 @@ class NormalizerOperator(BaseOperator):
         self.source_hook = BaseHook.get_hook(self.source_conn_id)
         self.destination_hook = BaseHook.get_hook(self.destination_conn_id)
 
-        mapping_dict = yaml.load(self.mapping, Loader=yaml.Loader)
-
-        deepness = [key.count(".") for key in mapping_dict.keys()]
-        roots = [get_table(key) for key in mapping_dict.keys() if key.count(".") == min(deepness)]
-        for root in roots:
-            filtered = {key: value for key, value in mapping_dict.items() if root in key}
-            mappings = {get_table(key): MappingElements(mapping_dict[key]) for key in filtered}
-            selected = [get_fields(key) for key in filtered.keys() if get_table(key) == root][0]
-
-            # Header-style
-            if selected:
-                fields = [x.strip() for x in selected.split("+")]
-                columns = [x.strip("*") for x in fields]
-                expands = [x.strip("*") for x in fields if "**" in x]
-
-            # Body-style
-            else:
-                fields = list({x.split(".")[0] for x in mappings[root].original})
-                columns = [x.strip("*") for x in fields]
-                extract = [x for x in mappings[root].original if "**" in x or "." in x]
-                expands = {x.split(".")[0]: [] for x in extract}
-                for item in extract:
-                    if "." in item:
-                        column, field = item.split(".")
-                        expands[column].append(field)
-
+        for root, mappings, columns, expands, operations in compile_mapping(self.mapping):
             self.log.info("Table processing: %s", root)
             self.log.info("Columns to be selected: %s", columns)
             self.log.info("Columns to be unpacked: %s", expands)
 
             self.initialize(root, mappings)
-            self.normalize(root, mappings, columns, expands)
+            self.normalize(root, mappings, columns, operations)
 
     def initialize(self, root: str, mappings: dict):
         """Initialize buffers and create tables."""
 
         self.log.info("Initialize buffers for %s", self.destination_conn_id)
-        self.ids = {}
-        self.buffers = {}
-        self.relations = {}
+        # Tables are addressed by slot, the index of the table in mappings
+        self.slots = {key: slot for slot, key in enumerate(mappings)}
+        self.ids = array('q', [0] * len(mappings))
+        self.buffers = [None] * len(mappings)
+        self.relations = [None] * len(mappings)
+        self.converters = [None] * len(mappings)
+
+        multiple = self.destination_hook.conn_type in DATABASES_MULTIPLE_VALUES_INSERT_SUPPORTS
+        stringify = multiple and self.destination_hook.conn_type not in DATABASES_BULK_INSERT_SUPPORTS
 
         queries = []
+        drop_table = compile_query(self.drop_table_query)
+        select_max = compile_query(self.select_max_query)
+        create_tpls = self.create_table_query
+        create_tpls = [create_tpls] if isinstance(create_tpls, str) else list(create_tpls)
+        create_tables = [compile_query(sql) for sql in create_tpls]
+
+        selects = {}
         table = root.split(".")[-1]
         serial = self.primary_key_type
         short = self.primary_key_short
         delim = self.primary_key_delim
-        for key in mappings:
-            self.buffers[key] = []
+        for slot, key in enumerate(mappings):
+            self.converters[slot] = [make_converter(cast, stringify) for cast in mappings[key].types]
 
             destination = mappings[key].destination
 
             # Get relations
-            parts = key.replace(root, table).split(".")
-            parent_key = ".".join(parts[:-1]).replace(table, root)
+            parent_key, _, this = key.rpartition(".") if key != root else ("", "", table)
             parent = mappings[parent_key].destination if parent_key else None
-            this = parts[-1]
 
             # By default is `id`, otherwise `<this_table>__id`
             pk = self.primary_key_name if short else f"{this}{delim}{self.primary_key_name}"
@@ -194,9 +214,12 @@ class NormalizerOperator(BaseOperator):
             fk = f"{parent}{delim}{self.primary_key_name}" if parent else None
             fk_type = [f"{fk} {serial}"] if fk else []
 
-            self.relations[key] = (fk, pk)
+            self.relations[slot] = (fk, pk)
             definition = ", ".join(fk_type + pk_type + mappings[key].definition)
 
+            # Buffer is stored by columns
+            self.buffers[slot] = [[] for _ in fk_type + pk_type + mappings[key].definition]
+
             parameters = {
                 'pk': pk,
                 'fk': fk,
@@ -205,144 +228,244 @@ class NormalizerOperator(BaseOperator):
             }
 
             if self.incremental:
-                try:
-                    latest_id = self.destination_hook.get_first(
-                        self.select_max_query.format(**parameters)
-                    )[0]
-                    self.ids[key] = latest_id or 0
-                except Exception:
-                    self.log.warning(f"Table `{key}` have not been created yet")
-                    self.ids[key] = 0
+                selects[key] = select_max(parameters)
             else:
-                self.ids[key] = 0
-                queries += [self.drop_table_query.format(**parameters)]
+                queries += [drop_table(parameters)]
+
+            queries += [create_table(parameters) for create_table in create_tables]
+
+        if self.incremental:
+            for key, latest_id in self.select_latest_ids(selects).items():
+                self.ids[self.slots[key]] = latest_id
+
+        # All statements are executed on one connection and committed once
+        self.destination_hook.run(queries, autocommit=False)
+
+    def select_latest_ids(self, selects: dict) -> dict:
+        """Get latest ids of tables with one round-trip, otherwise table by table."""
+
+        keys = list(selects)
+        if len(keys) > 1:
+            sql = "\nUNION ALL\n".join(
+                f"SELECT {index} AS slot, ({selects[key]}) AS latest_id"
+                for index, key in enumerate(keys)
+            )
+            try:
+                return {keys[slot]: latest_id or 0 for slot, latest_id in self.destination_hook.get_records(sql)}
+            # E.g. tables have not been created yet or query can't be used as subquery
+            except Exception as e:
+                self.log.warning(f"Latest ids can't be selected at once, select table by table: {e}")
+
+        ids = {}
+        for key in keys:
+            try:
+                latest_id = self.destination_hook.get_first(selects[key])[0]
+                ids[key] = latest_id or 0
+            except Exception:
+                self.log.warning(f"Table `{key}` have not been created yet")
+                ids[key] = 0
+
+        return ids
+
+    def extract(self, parameters: dict):
+        """Read source table by chunks of `commit_every` rows, streaming rows of every chunk."""
+
+        limit = self.commit_every
+        self.log.info(f"Partition size: {limit}")
+
+        # Single scan with server-side cursor if supported
+        if self.source_hook.conn_type in DATABASES_SERVER_SIDE_CURSOR_SUPPORTS:
+            with closing(self.source_hook.get_conn()) as conn:
+                with closing(conn.cursor(name=f"normalizer_{uuid4().hex}")) as cur:
+                    cur.execute(compile_query(self.select_all_query)(parameters))
 
-            if isinstance(self.create_table_query, str):
-                self.create_table_query = [self.create_table_query]
+                    # One round trip per chunk, which must be consumed before the next one
+                    rows = fetch(cur, limit)
+                    offset = 0
+                    for row in rows:
+                        self.log.info(f"Processing: {offset}")
+                        offset += limit
+                        yield chain([row], islice(rows, limit - 1))
 
-            queries += [sql.format(**parameters) for sql in self.create_table_query]
+            return
 
-        self.destination_hook.run(queries)
+        # Otherwise, LIMIT/OFFSET pagination
+        total = self.source_hook.get_first(
+            compile_query(self.select_count_query)(parameters)
+        )[0]
+        self.log.info(f"Total records found: {total}")
+
+        select_all = compile_query(self.select_all_query)(parameters)
+        with closing(self.source_hook.get_conn()) as conn:
+            with closing(conn.cursor()) as cur:
+                cur.arraysize = FETCH_SIZE
+
+                for offset in range(0, total, limit):
+                    self.log.info(f"Processing: {offset}/{total}")
+
+                    # TODO: it's different for mssql and oracle
+                    sql = select_all + f"""
+                        LIMIT {limit}
+                        OFFSET {offset}
+                    """
+                    cur.execute(sql)
+                    yield fetch(cur, FETCH_SIZE)
+
+    @contextmanager
+    def connections(self, size: int):
+        """Open pool of destination connections."""
+
+        connections = []
+        try:
+            for _ in range(size):
+                connections.append(self.destination_hook.get_conn())
+            yield connections
+        finally:
+            for conn in connections:
+                conn.close()
+
+    def insert(self, mappings: dict, connections: list, executor: ThreadPoolExecutor):
+        """Flush buffers with multiple values inserts within one transaction per connection.
+
+        With one connection the chunk is committed atomically. Several connections
+        are committed sequentially, so a failed commit can't undo the ones committed before it."""
+
+        conn_type = self.destination_hook.conn_type
+        insert_into = compile_query(self.insert_into_query)
+
+        pool = Queue()
+        for conn in connections:
+            pool.put(conn)
+
+        def execute(slot, key):
+            destination = mappings[key].destination
+
+            fk, pk = self.relations[slot]
+            fk = [fk] if fk else []
+            pk = [pk] if pk else []
+            fields = fk + pk + mappings[key].fields
+
+            columns = self.buffers[slot]
+            self.log.info(f"Insert {len(columns[0])} lines to `{key}`")
+            conn = pool.get()
+            try:
+                with closing(conn.cursor()) as cur:
+                    # Buffers contain parameters to be bound by the driver
+                    if conn_type == 'postgres':
+                        from psycopg2.extras import execute_values
+
+                        sql = insert_into({
+                            'table': destination,
+                            'fields': ", ".join(fields),
+                            'values': "%s",
+                        })
+                        execute_values(cur, sql, list(zip(*columns)), page_size=self.commit_every)
+
+                    elif conn_type == 'mysql':
+                        sql = insert_into({
+                            'table': destination,
+                            'fields': ", ".join(fields),
+                            'values': "(" + ", ".join(["%s"] * len(fields)) + ")",
+                        })
+                        cur.executemany(sql, list(zip(*columns)))
+
+                    # Otherwise, buffers contain stringified values
+                    else:
+                        head, _, tail = insert_into({
+                            'table': destination,
+                            'fields': ", ".join(fields),
+                            'values': "\0",
+                        }).partition("\0")
+                        # Statement is joined at once without intermediate string of values
+                        cur.execute("".join(chain([head], values_clause(zip(*columns)), [tail])))
+            finally:
+                pool.put(conn)
+
+        keys = []
+        for slot, key in enumerate(mappings):
+            if len(self.buffers[slot][0]) == 0:
+                self.log.info(f"No records found for `{key}`")
+            else:
+                keys.append((slot, key))
 
-    def normalize(self, root: str, mappings: dict, columns: list, expands: list):
+        try:
+            # Some drivers can't share connection with another thread
+            if len(connections) == 1:
+                for slot, key in keys:
+                    execute(slot, key)
+            else:
+                futures = [executor.submit(execute, slot, key) for slot, key in keys]
+                wait(futures)
+                for future in futures:
+                    future.result()
+
+            for conn in connections:
+                conn.commit()
+        except Exception:
+            for conn in connections:
+                # Rollback may fail itself, e.g. in autocommit mode
+                try:
+                    conn.rollback()
+                except Exception as e:
+                    self.log.warning(f"Rollback failed: {e}")
+            raise
+
+        for slot, columns in enumerate(self.buffers):
+            self.buffers[slot] = [[] for _ in columns]
+
+    def normalize(self, root: str, mappings: dict, columns: list, operations: list):
         """Restructuring data attributes into nested tables."""
 
         self.log.info("Extracting data from %s", self.source_conn_id)
         multiple = self.destination_hook.conn_type in DATABASES_MULTIPLE_VALUES_INSERT_SUPPORTS
+        stringify = multiple and self.destination_hook.conn_type not in DATABASES_BULK_INSERT_SUPPORTS
 
         parameters = {
             'table': root,
             'fields': ", ".join(columns),
         }
 
-        total = self.source_hook.get_first(
-            self.select_count_query.format(**parameters)
-        )[0]
-        self.log.info(f"Total records found: {total}")
+        # Parallel inserts to nested tables, each table through its own connection
+        workers = 1
+        if multiple and self.destination_hook.conn_type in DATABASES_PARALLEL_INSERT_SUPPORTS:
+            workers = min(len(mappings), self.max_workers)
 
-        limit = self.commit_every
-        self.log.info(f"Partition size: {limit}")
+        with self.connections(workers if multiple else 0) as connections, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
 
-        for offset in range(0, total, limit):
-            self.log.info(f"Processing: {offset}/{total}")
-
-            # TODO: it's different for mssql and oracle
-            sql = self.select_all_query.format(**parameters) + f"""
-                LIMIT {limit}
-                OFFSET {offset}
-            """
-            rows = self.source_hook.get_records(sql)
-
-            # Start processing chunk
-            for row in rows:
-                document = {}
-
-                for index, column_name in enumerate(columns):
-                    cell = row[index]
-
-                    # Header-style: merge fields into document
-                    if isinstance(expands, list):
-                        # json field
-                        if column_name in expands and isinstance(cell, dict):
-                            document.update(cell)
-                        # text field as json
-                        elif column_name in expands and isinstance(cell, str):
-                            document.update(json.loads(cell))
-                        # generic value
-                        else:
-                            document[column_name] = cell
-
-                    # Body-style: extracting fields from json
-                    if isinstance(expands, dict):
-                        data = None
-                        # json field
-                        if column_name in expands.keys() and isinstance(cell, dict):
-                            data = cell
-                        # text field as json
-                        if f"{column_name}**" in expands.keys():
-                            column_name = f"{column_name}**"
-                            data = json.loads(cell) if isinstance(cell, str) else cell
-
-                        if data is not None:
-                            # whole json
-                            if expands[column_name] == []:
-                                document[column_name] = [data]
-                            # single fields
-                            else:
-                                flat = flatten(data)
-                                for field in expands[column_name]:
-                                    document[f"{column_name}.{field}"] = flat[field] if field in flat else None
-                        else:
-                            document[column_name] = cell
-
-                # One document can be preprocessed to a list of documents with user defined function
-                documents = self.preprocessing(document) if callable(self.preprocessing) else [document]
-
-                normalize(documents, self.buffers, self.ids, mappings, root, stringify_values=multiple)
-
-            # Use multiple values inserting if supported
-            if multiple:
-                with closing(self.destination_hook.get_conn()) as conn:
-                    with closing(conn.cursor()) as cur:
-
-                        for key in mappings:
-                            destination = mappings[key].destination
-
-                            if len(self.buffers[key]) == 0:
-                                self.log.info(f"No records found for `{key}`")
-                                self.buffers[key] = []
-                                continue
-
-                            fk, pk = self.relations[key]
-                            fk = [fk] if fk else []
-                            pk = [pk] if pk else []
-                            fields = ", ".join(fk + pk + mappings[key].fields)
-
-                            self.log.info(f"Insert {len(self.buffers[key])} lines to `{key}`")
-                            cur.execute(
-                                self.insert_into_query.format(
-                                    table=destination,
-                                    fields=fields,
-                                    values=", ".join(self.buffers[key]),
-                                )
-                            )
-
-                            self.buffers[key] = []
-
-                        conn.commit()
-
-            # Otherwise, generates tonns of singe INSERT INTO operators
-            else:
-                for key in mappings:
-                    destination = mappings[key].destination
-                    # TODO: implementation "stringify no"
-                    self.destination_hook.insert_rows(
-                        table=destination,
-                        rows=self.buffers[key],
-                        **self.insert_args
+            for rows in self.extract(parameters):
+                # Start processing chunk
+                for row in rows:
+                    document = {}
+
+                    for apply in operations:
+                        apply(row, document)
+
+                    # One document can be preprocessed to a list of documents with user defined function
+                    documents = self.preprocessing(document) if callable(self.preprocessing) else [document]
+
+                    normalize(
+                        documents, self.buffers, self.ids, mappings, root, self.slots,
+                        stringify_values=stringify, converters=self.converters,
                     )
-                    self.buffers[key] = []
 
+                # Use multiple values inserting if supported
+                if multiple:
+                    self.insert(mappings, connections, executor)
+
+                # Otherwise, generates tonns of singe INSERT INTO operators
+                else:
+                    for slot, key in enumerate(mappings):
+                        destination = mappings[key].destination
+                        self.destination_hook.insert_rows(
+                            table=destination,
+                            rows=list(zip(*self.buffers[slot])),
+                            **self.insert_args
+                        )
+                        self.buffers[slot] = [[] for _ in self.buffers[slot]]
+
+        del self.slots
         del self.ids
         del self.buffers
         del self.relations
+        del self.converters
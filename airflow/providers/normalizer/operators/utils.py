@@ -1,10 +1,64 @@
+import re
 import json
+import string
 import datetime
+import functools
+from collections import defaultdict, deque, namedtuple
+
+import yaml
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# C-accelerated libyaml loader if available
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Integers beyond 64 bits are parsed by orjson as floats without an error,
+# e.g. 20 digits above uint64 max or 19 digits below int64 min
+BIG_NUMBER = re.compile(r"\d{19}")
+
+
+def loads(text):
+    """Decode json with orjson if available, falling back to the standard
+    library for documents orjson rejects or would lose precision on."""
+    if orjson and not BIG_NUMBER.search(text):
+        try:
+            return orjson.loads(text)
+        # NaN, Infinity, lone surrogates and other non-strict input
+        except orjson.JSONDecodeError:
+            pass
+
+    return json.loads(text)
+
+
+def dumps(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
+KeyInfo = namedtuple("KeyInfo", ["table", "fields", "depth", "parts"])
+
+MappingPlan = namedtuple("MappingPlan", ["root", "mappings", "columns", "expands", "operations"])
 
 
 class MappingElements:
 
-    def __init__(self, translation):
+    __slots__ = (
+        'destination',
+        'table',
+        'mapping',
+        'original',
+        'fields',
+        'types',
+        'definition',
+        'uniques',
+        'has_uniques',
+        'nested_keys',
+    )
+
+    def __init__(self, translation, nested_keys=()):
 
         destination = list(translation.keys())[0]
         # 'schema.table'
@@ -38,49 +92,233 @@ class MappingElements:
         self.table = table
         self.mapping = mapping
         self.original = original
-        self.fieldset = fieldset
         self.fields = fields
         self.types = types
         self.definition = definition
         self.uniques = uniques
         self.has_uniques = has_uniques
+        self.nested_keys = frozenset(nested_keys)
 
     def __str__(self):
         return self.definition
 
 
 def get_table(key):
-    return key.split("[")[0].strip("[]") if "[" in key else key
+    return key.partition("[")[0]
 
 
 def get_fields(key):
-    return key.split("[")[1].strip("[]") if "[" in key else None
+    _, bracket, fields = key.partition("[")
+    return fields.strip("[]") if bracket else None
+
+
+def parse_key(key):
+    table = get_table(key)
+    parts = tuple(table.split("."))
+    return KeyInfo(table, get_fields(key), len(parts), parts)
+
+
+@functools.lru_cache(maxsize=32)
+def compile_mapping(text):
+    """Parse YAML specification and precompute structures for every root table."""
+
+    mapping_dict = yaml.load(text, Loader=Loader)
+
+    keys = {key: parse_key(key) for key in mapping_dict}
+    deepness = min(info.depth for info in keys.values())
+
+    # Group nested tables by the root table they belong to
+    roots = [info for info in keys.values() if info.depth == deepness]
+    groups = defaultdict(list)
+    for key, info in keys.items():
+        groups[info.parts[:deepness]].append(key)
+
+    plans = []
+    for root_info in roots:
+        root = root_info.table
+        group = groups[root_info.parts]
+        mappings = {}
+        for key in group:
+            info = keys[key]
+            # Nested tables relative to this one, e.g. 'options' or 'options.items'
+            nested_keys = [
+                ".".join(keys[nested].parts[info.depth:]) for nested in group
+                if keys[nested].depth > info.depth and keys[nested].parts[:info.depth] == info.parts
+            ]
+            mappings[info.table] = MappingElements(mapping_dict[key], nested_keys=nested_keys)
+
+        selected = root_info.fields
+
+        # Header-style
+        if selected:
+            fields = [x.strip() for x in selected.split("+")]
+            columns = [x.strip("*") for x in fields]
+            expands = [x.strip("*") for x in fields if x.endswith("**")]
+
+        # Body-style
+        else:
+            fields = {}
+            expands = {}
+            for item in mappings[root].original:
+                column, dot, field = item.partition(".")
+                fields[column] = None
+                if dot or column.endswith("**"):
+                    expands.setdefault(column, [])
+                if dot:
+                    expands[column].append(field)
 
+            columns = [x.strip("*") for x in fields]
 
-def flatten(dictionary, parent_key='', delim='__'):
-    items = []
-    for key, value in dictionary.items():
-        child_key = f"{parent_key}{delim}{key}" if parent_key else key
-        if isinstance(value, dict):
-            items.extend(flatten(value, child_key, delim=delim).items())
+        operations = compile_columns(columns, expands)
+        plans.append(MappingPlan(root, mappings, columns, expands, operations))
+
+    return tuple(plans)
+
+
+@functools.lru_cache(maxsize=32)
+def compile_query(template):
+    """Split query template once and return function rendering it with parameters."""
+
+    pieces = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        # Complex replacement fields are left to str.format
+        if field is not None and (spec or conversion or not field.isidentifier()):
+            return lambda parameters: template.format(**parameters)
+        pieces.append((literal, field))
+
+    def render(parameters):
+        return "".join([
+            literal if field is None else literal + str(parameters[field])
+            for literal, field in pieces
+        ])
+
+    return render
+
+
+def copy_value(index, name):
+    def apply(row, document):
+        document[name] = row[index]
+
+    return apply
+
+
+def merge_json(index, name):
+    def apply(row, document):
+        cell = row[index]
+        # json field
+        if isinstance(cell, dict):
+            document.update(cell)
+        # text field as json
+        elif isinstance(cell, str):
+            document.update(loads(cell))
+        # generic value
+        else:
+            document[name] = cell
+
+    return apply
+
+
+def unpack_json(document, name, targets, data):
+    # whole json
+    if not targets:
+        document[name] = [data]
+    # single fields
+    else:
+        flat = flatten(data)
+        for target, field in targets:
+            document[target] = flat.get(field)
+
+
+def extract_json(index, name, fields):
+    targets = [(f"{name}.{field}", field) for field in fields]
+
+    def apply(row, document):
+        cell = row[index]
+        # json field
+        if isinstance(cell, dict):
+            unpack_json(document, name, targets, cell)
         else:
-            items.append((child_key, value))
+            document[name] = cell
 
-    return dict(items)
+    return apply
+
+
+def extract_json_text(index, name, fields):
+    targets = [(f"{name}.{field}", field) for field in fields]
+
+    def apply(row, document):
+        cell = row[index]
+        # text field as json
+        data = loads(cell) if isinstance(cell, str) else cell
+        if data is not None:
+            unpack_json(document, name, targets, data)
+        else:
+            document[name] = cell
+
+    return apply
+
+
+def compile_columns(columns, expands):
+    """Build functions filling the document from the cells of selected row."""
+
+    operations = []
+    for index, column_name in enumerate(columns):
+        # Header-style: merge fields into document
+        if isinstance(expands, list):
+            if column_name in expands:
+                operations.append(merge_json(index, column_name))
+            else:
+                operations.append(copy_value(index, column_name))
+
+        # Body-style: extracting fields from json
+        elif f"{column_name}**" in expands:
+            column_name = f"{column_name}**"
+            operations.append(extract_json_text(index, column_name, expands[column_name]))
+        elif column_name in expands:
+            operations.append(extract_json(index, column_name, expands[column_name]))
+        else:
+            operations.append(copy_value(index, column_name))
+
+    return operations
+
+
+def fetch(cursor, size):
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+
+        yield from rows
+
+
+def flatten(dictionary, parent_key='', delim='__'):
+    items = {}
+    stack = [(parent_key, dictionary)]
+    while stack:
+        prefix, current = stack.pop()
+        for key, value in current.items():
+            child_key = f"{prefix}{delim}{key}" if prefix else key
+            # Only plain dicts are nested
+            if type(value) is dict:
+                stack.append((child_key, value))
+            else:
+                items[child_key] = value
+
+    return items
 
 
 def prepare_value(value, cast):
     if (cast == 'timestamp' or cast == 'datetime64') and value:
         value = value.strftime("%Y-%m-%d %H:%M:%S.%f")
 
-    if cast == 'datetime' and value and isinstance(value, datetime):
+    if cast == 'datetime' and value and isinstance(value, datetime.datetime):
         value = value.strftime("%Y-%m-%d %H:%M:%S")
 
     if cast == 'date' and value:
         value = str(value)
 
     if isinstance(value, list) or isinstance(value, dict):
-        value = json.dumps(value, ensure_ascii=False)
+        value = dumps(value)
 
     if isinstance(value, bool):
         value = str(value).lower()
@@ -98,37 +336,105 @@ def prepare_value(value, cast):
     return value
 
 
-def normalize(documents, buffers, ids, mappings, parent_key, fk=0, id=0, delim="__", stringify_values=True):
-    if parent_key not in buffers:
-        buffers[parent_key] = []
+def prepare_parameter(value):
+    if isinstance(value, list) or isinstance(value, dict):
+        value = dumps(value)
+
+    return value
+
+
+def quote(value):
+    # Two str.replace are faster than str.translate with a multi-char table
+    return "'" + value.replace("\\", "\\\\").replace("'", "''") + "'"
+
+
+LITERALS = {
+    type(None): lambda value: 'NULL',
+    bool: lambda value: quote(str(value).lower()),
+    int: str,
+    float: str,
+    str: quote,
+    list: lambda value: quote(dumps(value)),
+    dict: lambda value: quote(dumps(value)),
+}
+
+
+def prepare_literal(value):
+    convert = LITERALS.get(type(value))
+    return convert(value) if convert else prepare_value(value, None)
+
+
+def make_converter(cast, stringify_values=True):
+    """Build a function preparing values of the column with given type."""
+
+    if not stringify_values:
+        return prepare_parameter
+
+    if cast == 'timestamp' or cast == 'datetime64':
+        return lambda value: quote(value.strftime("%Y-%m-%d %H:%M:%S.%f")) if value else prepare_literal(value)
+
+    if cast == 'datetime':
+        return lambda value: (
+            quote(value.strftime("%Y-%m-%d %H:%M:%S"))
+            if value and isinstance(value, datetime.datetime)
+            else prepare_literal(value)
+        )
+
+    if cast == 'date':
+        return lambda value: quote(str(value)) if value else prepare_literal(value)
+
+    return prepare_literal
+
+
+def values_clause(rows):
+    separator = ""
+    for row in rows:
+        yield separator + "(" + ", ".join(row) + ")"
+        separator = ", "
+
+
+def normalize(documents, buffers, ids, mappings, root, slots, delim="__", stringify_values=True, converters=None):
+    if converters is None:
+        converters = [None] * len(slots)
+
+    # Nested lists are queued instead of recursion, keeping the order of ids
+    work = deque([(root, documents, 0)])
+    while work:
+        parent_key, documents, fk = work.popleft()
+        slot = slots[parent_key]
+        mapping = mappings[parent_key]
+        fields, original, nested_keys = mapping.fields, mapping.original, mapping.nested_keys
+
+        # Buffer is stored by columns: foreign key, primary key and fields
+        if buffers[slot] is None:
+            buffers[slot] = [[] for _ in range(len(fields) + (2 if fk else 1))]
 
-    # Filter the keys for current level to work with
-    nested_keys = [key.replace(parent_key+".", "") for key in mappings if parent_key in key and key != parent_key]
-    mapping = mappings[parent_key]
+        if converters[slot] is None:
+            converters[slot] = [make_converter(cast, stringify_values) for cast in mapping.types]
 
-    id = ids[parent_key] if not id else id
+        # Emit values straight to the key columns and the field columns
+        columns = buffers[slot]
+        offset = len(columns) - len(fields)
+        primary_column = columns[offset - 1]
+        foreign_column = columns[0] if fk else None
+        foreign_value = str(fk) if stringify_values else fk
+        emit = list(zip(fields, original, converters[slot], columns[offset:]))
 
-    for document in documents:
-        flat_document = flatten(document, delim=delim)
-        id += 1
+        id = ids[slot]
+        for document in documents:
+            flat_document = flatten(document, delim=delim)
+            id += 1
 
-        values = []
-        for i, key in enumerate(mapping.fields):
-            origin = mapping.original[i]
-            value = flat_document.get(origin)
-            cast = mapping.types[i]
-            prepared = prepare_value(value, cast)
-            values.append(prepared)
+            if fk:
+                foreign_column.append(foreign_value)
+            primary_column.append(str(id) if stringify_values else id)
 
-            # Check the nested fields to normalize
-            if value and isinstance(value, list) and key in nested_keys:
-                child_key = parent_key + "." + key
-                child_id = ids[child_key] if child_key in ids else 0
-                normalize(value, buffers, ids, mappings, child_key, fk=id, id=child_id)
+            for key, origin, prepare, column in emit:
+                value = flat_document.get(origin)
+                column.append(prepare(value))
 
-        # TODO: if stringify_values:
-        foreign_key = [str(fk)] if fk else []
-        values = foreign_key + [str(id)] + values
-        buffers[parent_key].append("(" + ", ".join(values) + ")")
+                # Check the nested fields to normalize
+                if value and isinstance(value, list) and key in nested_keys:
+                    work.append((parent_key + "." + key, value, id))
 
-    ids[parent_key] = id
+        ids[slot] = id
@@ -1,9 +1,108 @@
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 from airflow.providers.sqlite.operators.sqlite import SqliteOperator
 from airflow.providers.normalizer.operators.normalizer import NormalizerOperator
+from airflow.providers.normalizer.operators.utils import compile_mapping, normalize
 from airflow.exceptions import AirflowFailException
 
 
+MAPPING = """
+    postgres.orders:
+      staging.orders:
+        name:           { name: text }
+        items:          { items: text }
+    postgres.orders.items:
+      staging.order_items:
+        sku:            { sku: text }
+"""
+
+DOCUMENTS = [
+    {"name": "o1", "items": [{"sku": "a"}, {"sku": "b"}]},
+    {"name": "o2", "items": [{"sku": "c"}]},
+]
+
+
+class StubCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql):
+        self.conn.calls.append("execute")
+        self.conn.statements.append(sql)
+        if self.conn.fail_on and self.conn.fail_on in sql:
+            raise RuntimeError(f"Insert to {self.conn.fail_on} failed")
+
+    def close(self):
+        pass
+
+
+class StubConnection:
+    def __init__(self, fail_on=None, rollback_error=None):
+        self.fail_on = fail_on
+        self.rollback_error = rollback_error
+        self.calls = []
+        self.statements = []
+
+    def cursor(self, name=None):
+        return StubCursor(self)
+
+    def commit(self):
+        self.calls.append("commit")
+
+    def rollback(self):
+        self.calls.append("rollback")
+        if self.rollback_error:
+            raise self.rollback_error
+
+    def close(self):
+        self.calls.append("close")
+
+
+class StubHook:
+    def __init__(self, conn_type, connections=(), records=None, first=None):
+        self.conn_type = conn_type
+        self.connections = list(connections)
+        self.records = records
+        self.first = first or {}
+        self.queries = []
+
+    def get_conn(self):
+        return self.connections.pop(0)
+
+    def run(self, sql, autocommit=False):
+        self.queries.append(sql)
+
+    def get_records(self, sql):
+        self.queries.append(sql)
+        if isinstance(self.records, Exception):
+            raise self.records
+        return self.records
+
+    def get_first(self, sql):
+        self.queries.append(sql)
+        if isinstance(self.first[sql], Exception):
+            raise self.first[sql]
+        return self.first[sql]
+
+
+def prepare_insert(conn_type, connections):
+    operator = NormalizerOperator(
+        task_id="test",
+        source_conn_id="postgres_default",
+        destination_conn_id="trino_default",
+        mapping=MAPPING,
+    )
+    operator.destination_hook = StubHook(conn_type, connections)
+
+    plan, = compile_mapping(MAPPING)
+    operator.initialize(plan.root, plan.mappings)
+    normalize(
+        DOCUMENTS, operator.buffers, operator.ids, plan.mappings, plan.root, operator.slots,
+        converters=operator.converters,
+    )
+    return operator, plan.mappings
+
+
 def test_normalize_success():
     insert = '{"date": "2023-01-16"}'
 
@@ -39,3 +138,81 @@ def test_normalize_success():
 
     with pytest.raises(AirflowFailException):
         operator.execute({})
+
+
+def test_insert_serial():
+    conn = StubConnection()
+    operator, mappings = prepare_insert("sqlite", [conn])
+
+    with operator.connections(1) as connections, ThreadPoolExecutor(max_workers=1) as executor:
+        operator.insert(mappings, connections, executor)
+
+    # All tables are committed at once through the single connection
+    assert conn.calls == ["execute", "execute", "commit", "close"]
+    assert [sql.split()[2] for sql in conn.statements] == ["staging.orders", "staging.order_items"]
+    assert all(len(column) == 0 for columns in operator.buffers for column in columns)
+
+
+def test_insert_parallel():
+    pool = [StubConnection(), StubConnection()]
+    operator, mappings = prepare_insert("trino", pool)
+
+    with operator.connections(2) as connections, ThreadPoolExecutor(max_workers=2) as executor:
+        operator.insert(mappings, connections, executor)
+
+    # Every table is inserted once, through any of connections
+    tables = sorted(sql.split()[2] for conn in pool for sql in conn.statements)
+    assert tables == ["staging.order_items", "staging.orders"]
+    assert all(conn.calls.count("commit") == 1 for conn in pool)
+    assert all("rollback" not in conn.calls for conn in pool)
+
+
+def test_insert_rollback():
+    pool = [
+        StubConnection(fail_on="staging.order_items", rollback_error=RuntimeError("No transaction")),
+        StubConnection(fail_on="staging.order_items", rollback_error=RuntimeError("No transaction")),
+    ]
+    operator, mappings = prepare_insert("trino", pool)
+
+    # Original error is raised even if rollback fails itself
+    with pytest.raises(RuntimeError, match="Insert to staging.order_items failed"):
+        with operator.connections(2) as connections, ThreadPoolExecutor(max_workers=2) as executor:
+            operator.insert(mappings, connections, executor)
+
+    assert all("commit" not in conn.calls for conn in pool)
+    assert all(conn.calls[-2:] == ["rollback", "close"] for conn in pool)
+
+
+def test_select_latest_ids():
+    operator = NormalizerOperator(
+        task_id="test",
+        source_conn_id="postgres_default",
+        destination_conn_id="trino_default",
+        mapping=MAPPING,
+    )
+    selects = {
+        "postgres.orders": "SELECT max(id) FROM staging.orders",
+        "postgres.orders.items": "SELECT max(id) FROM staging.order_items",
+    }
+
+    # One query for all tables, slots are mapped back to keys
+    operator.destination_hook = StubHook("trino", records=[(1, None), (0, 5)])
+    assert operator.select_latest_ids(selects) == {"postgres.orders": 5, "postgres.orders.items": 0}
+    assert len(operator.destination_hook.queries) == 1
+    assert "UNION ALL" in operator.destination_hook.queries[0]
+
+    # Otherwise, table by table
+    operator.destination_hook = StubHook(
+        "trino",
+        records=RuntimeError("Table not found"),
+        first={
+            selects["postgres.orders"]: (7, ),
+            selects["postgres.orders.items"]: RuntimeError("Table not found"),
+        },
+    )
+    assert operator.select_latest_ids(selects) == {"postgres.orders": 7, "postgres.orders.items": 0}
+    assert operator.destination_hook.queries[1:] == list(selects.values())
+
+    # Null max of empty table
+    operator.destination_hook = StubHook("trino", first={selects["postgres.orders"]: (None, )})
+    assert operator.select_latest_ids({"postgres.orders": selects["postgres.orders"]}) == {"postgres.orders": 0}
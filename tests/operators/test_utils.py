@@ -0,0 +1,121 @@
+import math
+import datetime
+
+from airflow.providers.normalizer.operators.utils import (
+    compile_mapping,
+    compile_query,
+    flatten,
+    loads,
+    make_converter,
+    normalize,
+)
+
+
+def test_flatten():
+    document = {
+        "id": 1,
+        "client": {"id": 2, "branch": {"id": 3}},
+        "items": [{"id": 4}],
+        "empty": {},
+    }
+
+    assert flatten(document) == {
+        "id": 1,
+        "client__id": 2,
+        "client__branch__id": 3,
+        "items": [{"id": 4}],
+    }
+    assert flatten(document["client"], parent_key="client", delim=".") == {
+        "client.id": 2,
+        "client.branch.id": 3,
+    }
+
+
+def test_loads():
+    assert loads('{"id": 1, "name": "a"}') == {"id": 1, "name": "a"}
+
+    # Integers beyond 64 bits keep exact values
+    assert loads('{"id": 123456789012345678901234567890}') == {"id": 123456789012345678901234567890}
+    assert loads('{"id": -9223372036854775809}') == {"id": -9223372036854775809}
+    assert loads('{"id": 18446744073709551616}') == {"id": 18446744073709551616}
+
+    # Non-strict json is accepted as by the standard library
+    assert math.isnan(loads('{"x": NaN}')["x"])
+    assert loads('[Infinity, -Infinity]') == [math.inf, -math.inf]
+
+
+def test_compile_query():
+    render = compile_query("SELECT {fields} FROM {table} WHERE {{x}} > {pk}")
+
+    assert render({"fields": "a, b", "table": "t", "pk": None}) == "SELECT a, b FROM t WHERE {x} > None"
+    assert compile_query("ORDER BY {pk!r:>5}")({"pk": "id"}) == "ORDER BY  'id'"
+
+
+def test_normalize_nested():
+    plan, = compile_mapping("""
+        postgres.orders:
+          staging.orders:
+            id:           { origin_id: bigint }
+            items:        { items: text }
+        postgres.orders.items:
+          staging.order_items:
+            sku:          { sku: text }
+            options:      { options: text }
+        postgres.orders.items.options:
+          staging.order_item_options:
+            name:         { name: text }
+    """)
+    documents = [
+        {"id": 10, "items": [{"sku": "a", "options": [{"name": "x"}, {"name": "y"}]}, {"sku": "b"}]},
+        {"id": 20, "items": [{"sku": "c", "options": [{"name": "z"}]}]},
+    ]
+    slots = {key: slot for slot, key in enumerate(plan.mappings)}
+
+    buffers, ids = [None] * len(slots), [0] * len(slots)
+    normalize(documents, buffers, ids, plan.mappings, plan.root, slots)
+
+    orders, items, options = buffers
+    # root table has primary key only, nested tables have foreign key first
+    assert orders[:2] == [["1", "2"], ["10", "20"]]
+    assert items[:3] == [["1", "1", "2"], ["1", "2", "3"], ["'a'", "'b'", "'c'"]]
+    assert options == [["1", "1", "3"], ["1", "2", "3"], ["'x'", "'y'", "'z'"]]
+    assert ids == [2, 3, 3]
+
+    buffers, ids = [None] * len(slots), [0] * len(slots)
+    normalize(documents, buffers, ids, plan.mappings, plan.root, slots, stringify_values=False)
+
+    orders, items, options = buffers
+    assert orders[0] == [1, 2]
+    assert items[:2] == [[1, 1, 2], [1, 2, 3]]
+    assert options == [[1, 1, 3], [1, 2, 3], ["x", "y", "z"]]
+
+
+def test_compile_mapping_roots_with_common_prefix():
+    plans = compile_mapping("""
+        main.orders:
+          staging.orders:
+            id:           { id: bigint }
+            items:        { items: text }
+        main.orders.items:
+          staging.order_items:
+            sku:          { sku: text }
+        main.orders_archive:
+          staging.orders_archive:
+            id:           { id: bigint }
+    """)
+
+    assert [(plan.root, list(plan.mappings)) for plan in plans] == [
+        ("main.orders", ["main.orders", "main.orders.items"]),
+        ("main.orders_archive", ["main.orders_archive"]),
+    ]
+
+
+def test_make_converter_datetime():
+    convert = make_converter("datetime")
+
+    assert convert(datetime.datetime(2020, 1, 2, 3, 4, 5, 678)) == "'2020-01-02 03:04:05'"
+    assert convert("2020-01-02") == "'2020-01-02'"
+    assert convert(None) == "NULL"
+
+    # Parameters are bound by the driver as is
+    assert make_converter("datetime", stringify_values=False)(None) is None